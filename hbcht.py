@@ -35,27 +35,27 @@ from optparse import OptionParser
 import array
 import random
 import io
-import struct
 import re
-import collections
-import itertools
 import locale
-
-def _traverse(it):
-    for x in it: pass
-(lambda vardict, consts: _traverse(vardict.__setitem__(x, i)
-                          for x, i in itertools.zip_longest(
-            consts, range(len(consts)))))(
-    sys.modules[__name__].__dict__,
-    ('NOP', 'DECREMENT', 'INCREMENT', 'PREV', 'NEXT', 'IF', 'GOTO', 'EXIT',
-     'CAR',
-     'UP', 'RIGHT', 'DOWN', 'LEFT',
-     'HBCHT', 'PYTHON', 'C', 'BRAINFUCK'
-     ))
+import hashlib
+import subprocess
+import tempfile
+import shutil
+import stat
+
+(NOP, DECREMENT, INCREMENT, PREV, NEXT, IF, GOTO, EXIT,
+ CAR,
+ UP, RIGHT, DOWN, LEFT,
+ HBCHT, PYTHON, C, BRAINFUCK
+ ) = range(17)
 
 _direction_text_to_const_map = {
     'u': UP, 'r': RIGHT, 'd': DOWN, 'l': LEFT
     }
+# The same, keyed by the lowercase code point; ASCII letters are lowercased
+# by setting bit 0x20
+_direction_ord_to_const_map = dict((ord(k), v) for k, v in
+                                   _direction_text_to_const_map.items())
 
 _direction_to_path_map = {
     UP: 0, RIGHT: 1, DOWN: 2, LEFT: 3
@@ -75,9 +75,23 @@ _opcode_to_const_map = {ord(k): v for k, v in {
     '>': NEXT, '/': IF, '#': EXIT, 'o': CAR
     }.items()}
 
+# bytes.translate table from source characters to operations
+_opcode_table = bytes(_opcode_to_const_map.get(c, NOP) for c in range(256))
+_nop_byte, _car_byte, _exit_byte = bytes((NOP,)), bytes((CAR,)), bytes((EXIT,))
+_operation_pattern = re.compile(b'[^' + re.escape(_nop_byte) + b']')
+
 _valid_directions = (UP, RIGHT, DOWN, LEFT)
 _accepted_languages = (HBCHT, PYTHON, C) #, BRAINFUCK)
 _base_mem_ops = (DECREMENT, INCREMENT, PREV, NEXT)
+# Version of the parse cache files; bump it when the commands generated from
+# source code change
+_cache_version = 3
+
+# array type code of the little-endian 32-bit words in compiled programs
+_uint32_code = 'I' if array.array('I').itemsize == 4 else 'L'
+
+# Interpreter-only operations, never stored in commands (see _pack_commands)
+_GOTO_IF, _COUNT_IF = 0xff, 0xfe
 
 _ops_to_dirs_map = {
     DECREMENT: DOWN, INCREMENT: UP, PREV: LEFT, NEXT: RIGHT
@@ -86,6 +100,18 @@ _compl_action_map = {
     DECREMENT: INCREMENT, INCREMENT: DECREMENT, PREV: NEXT, NEXT: PREV
     }
 
+# Number of zero cells the interpreter allocates on each side of the input
+# before it has to grow its tape (at least 1, as IF reads the cell before #0)
+_tape_margin = 64
+
+# Programs with more commands than this are interpreted instead of being
+# compiled into a Python function when run, as compiling takes too long
+_codegen_limit = 2000
+# Programs are interpreted until they have taken this many jumps per command
+# in total (over all runs), and then compiled into a Python function, so that
+# short runs do not pay for compiling
+_codegen_budget = 100
+
 
 # Python code output
 ####################
@@ -113,8 +139,7 @@ def run(*inputs, **kwds):
         if ret is None:
             break
         action, i = ret
-    cells = sorted(filter(lambda kv: kv[1] != 0, cells.items()),
-                   key=lambda kv: kv[0])
+    cells = sorted([kv for kv in cells.items() if kv[1] != 0])
 {outputconv}
     return out
 '''
@@ -131,7 +156,7 @@ _python_code_wrapper_not_intext = '''\
     inputs = ninputs
 '''
 _python_code_wrapper_outtext = '''\
-    out = ''.join(chr(v) for k, v in cells)
+    out = ''.join([chr(v) for k, v in cells])
 '''
 _python_code_wrapper_not_outtext = '''\
     if format_output:
@@ -156,6 +181,21 @@ if __name__ == '__main__':
 # C code output
 ###############
 
+# Code of each command in the HBCHT_BODY macro, by operation
+_c_code_commands = {
+    DECREMENT: b'hbcht_dec_cell(cells, i, %d); \\\n',
+    INCREMENT: b'hbcht_inc_cell(cells, i, %d); \\\n',
+    PREV: b'i -= %d; \\\n',
+    NEXT: b'i += %d; \\\n',
+    GOTO: b'goto hbchtpos%d; \\\n',
+    IF: b'if (hbcht_get_cell_value(cells, i) != \
+hbcht_get_cell_value(cells, i - 1)) \\\n    goto hbchtpos%d; \\\n'
+    }
+_c_code_goto = _c_code_commands[GOTO]
+_c_code_label = b'hbchtpos%d: \\\n'
+_c_code_exit = b'goto hbchtposend; \\\n'
+_c_code_case = b'case %d: goto hbchtpos%d; break; \\\n'
+
 _c_template = b'''
 #include <stdio.h>
 #include <stdlib.h>
@@ -166,6 +206,7 @@ _c_template = b'''
 typedef struct {
     int *items;
     int length;
+    int capacity;
 } IntList;
 
 typedef struct {
@@ -183,6 +224,7 @@ void hbcht_intlist_init(IntList **list) {
     *list = (IntList*) malloc(sizeof(IntList));
     if (*list == NULL) exit(EXIT_FAILURE);
     (*list)->length = 0;
+    (*list)->capacity = 0;
     (*list)->items = (int*) malloc(0);
     if ((*list)->items == NULL) exit(EXIT_FAILURE);
 }
@@ -219,11 +261,23 @@ void hbcht_cells_destroy(HBCHTCells *cells) {
     free(cells);
 }
 
+void hbcht_intlist_reserve(IntList *list, int length) {
+    int capacity = list->capacity;
+    if (length <= capacity)
+        return;
+    /* grow geometrically, so that appending is amortized O(1) */
+    capacity *= 2;
+    if (capacity < length)
+        capacity = length;
+    list->items = (int*) realloc(list->items, sizeof(int) * capacity);
+    if (list->items == NULL) exit(EXIT_FAILURE);
+    list->capacity = capacity;
+}
+
 void hbcht_intlist_append(IntList *list, int num) {
+    hbcht_intlist_reserve(list, list->length + 1);
+    list->items[list->length] = num;
     list->length++;
-    list->items = (int*) realloc(list->items, sizeof(int) * list->length);
-    if (list->items == NULL) exit(EXIT_FAILURE);
-    list->items[list->length - 1] = num;
 }
 
 void hbcht_inc_cell_list(IntList *list, int pos, int inc) {
@@ -233,9 +287,7 @@ void hbcht_inc_cell_list(IntList *list, int pos, int inc) {
     else {
         olen = list->length;
         list->length += pos - list->length + 1;
-        list->items = (int*) realloc(list->items, sizeof(int)
-                                     * list->length);
-        if (list->items == NULL) exit(EXIT_FAILURE);
+        hbcht_intlist_reserve(list, list->length);
         for (i = olen; i < list->length - 1; i++)
             list->items[i] = 0;
         list->items[list->length - 1] = inc;
@@ -264,38 +316,29 @@ int hbcht_get_cell_value(HBCHTCells *cells, int pos) {
 
 HBCHTList* hbcht_cells_to_list(HBCHTCells *cells) {
     HBCHTList *l;
-    int *tl;
-    int i, j;
+    int i, j, neglen, poslen;
     hbcht_list_init(&l);
 
-    l->length = cells->negative->length + cells->positive->length;
+    /* leave out the zero cells at the end up front, so that the list is
+       allocated once with its final length */
+    poslen = cells->positive->length;
+    while (poslen > 0 && cells->positive->items[poslen - 1] == 0)
+        poslen--;
+    neglen = cells->negative->length;
+    j = 0; /* the number of zero cells from #-1 down that end the list */
+    if (poslen == 0)
+        while (j < neglen && cells->negative->items[j] == 0)
+            j++;
+    l->length = neglen - j + poslen;
+    l->offset = neglen;
     if (l->length == 0)
         return l;
 
-    l->offset = cells->negative->length;
     l->items = (int*) realloc(l->items, sizeof(int) * l->length);
     if (l->items == NULL) exit(EXIT_FAILURE);
-    i = 0;
-    for (j = cells->negative->length - 1; j >= 0; j--, i++) {
-        l->items[i] = cells->negative->items[j];
-    }
-    for (j = 0; j < cells->positive->length; j++, i++) {
-        l->items[i] = cells->positive->items[j];
-    }
-
-    j = l->length;
-    for (i = l->length - 1; i >= 0; i--) {
-        if (l->items[i] == 0)
-            (l->length)--;
-        else
-            break;
-    }
-    if (l->length == 0)
-        return l;
-    if (j != l->length) {
-        l->items = (int*) realloc(l->items, sizeof(int) * l->length);
-        if (l->items == NULL) exit(EXIT_FAILURE);
-    }
+    for (i = 0; i < neglen - j; i++)
+        l->items[i] = cells->negative->items[neglen - 1 - i];
+    memcpy(l->items + i, cells->positive->items, sizeof(int) * poslen);
     return l;
 }
 
@@ -425,10 +468,540 @@ int main (int argc, char* argv[]) {
     return ret;
 }
 '''
+# The end of C output with the main function
+_c_template_full = _c_template + _c_template_mainfunc
+
+###############
+
+# Native code output
+####################
+
+# Commands of the native function body, by opcode. Memory operations bail
+# out instead of growing the tape.
+_native_code_commands = {
+    DECREMENT: b'if (__builtin_sub_overflow(cells[i], %d, &cells[i])) \\\n\
+    return 1; \\\n',
+    INCREMENT: b'if (__builtin_add_overflow(cells[i], %d, &cells[i])) \\\n\
+    return 1; \\\n',
+    PREV: b'i -= %d; \\\n\
+if (i < lo) { if (i < 1) return 2; lo = i; } \\\n',
+    NEXT: b'i += %d; \\\n\
+if (i > hi) { if (i >= length) return 2; hi = i; } \\\n',
+    GOTO: b'goto hbchtpos%d; \\\n',
+    IF: b'if (cells[i] != cells[i - 1]) \\\n    goto hbchtpos%d; \\\n'
+    }
+_native_code_exit = b'goto hbchtposend; \\\n'
+_native_code_case = b'case %d: goto hbchtpos%d; \\\n'
+
+# Used by CarProgram.jit_native. The generated function runs one path on a
+# fixed-size tape of 64-bit cells and returns nonzero if the car leaves the
+# tape or a cell overflows, in which case the path is interpreted instead.
+_native_template = b'''
+#include <stdint.h>
+
+int hbcht_native_run(int64_t *cells, int64_t length, int64_t i, int path,
+                     int64_t *bounds) {
+    int64_t lo = i, hi = i;
+    HBCHT_BODY;
+ hbchtposend:
+    bounds[0] = lo;
+    bounds[1] = hi;
+    return 0;
+}
+'''
+
+# Number of cells on each side of the input on the native tape, at first and
+# at most (the tape is enlarged when the car runs off it)
+_native_tape_margin = 1 << 16
+_native_tape_max_margin = 1 << 22
 
 class CarError(Exception):
     pass
 
+def _text_codes(s):
+    """Return the code points of the characters in the str s."""
+    try:
+        return s.encode('ascii') # a bytes object iterates as its code points
+    except UnicodeEncodeError:
+        return [ord(c) for c in s]
+
+def _int_or_text(s):
+    """Return the str s as an int if it is a number, else unchanged."""
+    try:
+        return int(s)
+    except ValueError:
+        return s
+
+def _source_lines(data):
+    """
+    Return the non-empty lines of source code with comments removed, and
+    whether it has @intext and @outtext lines.
+    """
+    lines = []
+    idone, odone = False, False
+    for line in data.split(b'\n'):
+        if line.startswith(b'@intext'):
+            idone = True
+        elif line.startswith(b'@outtext'):
+            odone = True
+        else:
+            # remove eventual comment
+            line = line.partition(b';')[0].rstrip()
+            if line:
+                lines.append(line)
+    return lines, idone, odone
+
+def _cache_dir():
+    """
+    Return the directory of the hbcht caches, $XDG_CACHE_HOME/hbcht (by
+    default ~/.cache/hbcht), creating it readable only by the user if it
+    does not exist.
+    """
+    cachedir = os.path.join(os.environ.get('XDG_CACHE_HOME') or
+                            os.path.join(os.path.expanduser('~'), '.cache'),
+                            'hbcht')
+    try:
+        os.makedirs(cachedir, mode=0o700, exist_ok=True)
+    except OSError:
+        pass
+    return cachedir
+
+def _is_private(path):
+    """
+    Return whether path exists, is owned by the user, and cannot be written
+    by anyone else.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    if hasattr(os, 'getuid') and st.st_uid != os.getuid():
+        return False
+    return not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+def _cache_file(data):
+    """
+    Return the path and the header of the parse cache file for the source
+    code data. Cache files are kept in the directory from _cache_dir and
+    named after a hash of the source.
+    """
+    digest = hashlib.blake2b(data, digest_size=16)
+    return (os.path.join(_cache_dir(), digest.hexdigest() + '.hbc'),
+            b'\1hbcht-cache' + bytes((_cache_version,)) + digest.digest())
+
+def _skip_gotos(commands, j):
+    """Return the first command that is not a GOTO when starting at j."""
+    seen = set()
+    while commands[j][0] == GOTO and j not in seen:
+        seen.add(j)
+        j = commands[j][1]
+    return j
+
+def _peephole_commands(commands, begs):
+    """
+    Make every jump skip over the GOTOs it would land on, and turn GOTOs to
+    an EXIT into an EXIT. An IF that continues at the same command whichever
+    way it goes becomes a GOTO. Then drop the commands that are no longer
+    reached and the GOTOs to the next command. Return the new commands and
+    path beginnings.
+    """
+    ncommands = []
+    for j, (x, a) in enumerate(commands):
+        if x in (GOTO, IF):
+            a = _skip_gotos(commands, a)
+            if x == IF and a == _skip_gotos(commands, j + 1):
+                x = GOTO
+            if x == GOTO and commands[a][0] == EXIT:
+                x, a = EXIT, 0
+        ncommands.append((x, a))
+
+    reached = [False] * len(ncommands)
+    work = [0] + list(begs)
+    while work:
+        j = work.pop()
+        while not reached[j]:
+            reached[j] = True
+            x, a = ncommands[j]
+            if x == EXIT:
+                break
+            elif x == GOTO:
+                j = a
+            else:
+                if x == IF:
+                    work.append(a)
+                j += 1
+    keep = [False] * len(ncommands)
+    after = len(ncommands) # the first kept command after j
+    for j in range(len(ncommands) - 1, -1, -1):
+        x, a = ncommands[j]
+        if reached[j] and not (x == GOTO and a == after):
+            keep[j] = True
+            after = j
+    if all(keep) and ncommands == [tuple(c) for c in commands]:
+        return commands, begs
+    new_pos, n = [], 0
+    for k in keep:
+        new_pos.append(n)
+        n += k
+    ncommands = [(x, new_pos[a]) if x in (GOTO, IF) else (x, a)
+                 for (x, a), k in zip(ncommands, keep) if k]
+    return ncommands, [new_pos[b] for b in begs]
+
+def _coalesce_commands(commands, begs):
+    """
+    Merge runs of the same memory operation into a single command, except
+    where a jump or a path beginning lands inside the run. Return the new
+    commands and path beginnings.
+    """
+    targets = set(begs)
+    targets.update(a for x, a in commands if x in (GOTO, IF))
+    ncommands, new_pos = [], []
+    for j, (x, a) in enumerate(commands):
+        if ncommands and j not in targets and x in _base_mem_ops \
+                and ncommands[-1][0] == x:
+            ncommands[-1] = (x, ncommands[-1][1] + a)
+        else:
+            ncommands.append((x, a))
+        new_pos.append(len(ncommands) - 1)
+    if len(ncommands) == len(commands):
+        return commands, begs
+    ncommands = [(x, new_pos[a]) if x in (GOTO, IF) else (x, a)
+                 for x, a in ncommands]
+    return ncommands, [new_pos[b] for b in begs]
+
+def _known_cell(env, k):
+    """
+    Return the value of memory cell #k in env, or None if it is not known.
+    Cells that have not been written start out as 0 if they lie before cell
+    #0 and as an unknown input otherwise.
+    """
+    if k in env:
+        return env[k]
+    return 0 if k < 0 else None
+
+def _merge_fold_states(s, t):
+    """Return the state that holds where either state s or t holds."""
+    if s is None:
+        return t
+    (soff, senv), (toff, tenv) = s, t
+    off = soff if soff == toff else None
+    if senv is None or tenv is None:
+        return off, None
+    if senv is tenv:
+        return off, senv
+    env = {}
+    for k in set(senv).union(tenv):
+        v = _known_cell(senv, k)
+        if v != _known_cell(tenv, k):
+            v = None
+        if v != (0 if k < 0 else None): # store what differs from the start
+            env[k] = v
+    return off, env
+
+def _fold_constant_ifs(commands, begs):
+    """
+    Replace each IF whose test has the same outcome on every run with a
+    GOTO, and drop the commands that can then no longer be reached. The
+    car's offset from cell #0 and the cell values known at each command are
+    found by running all paths over abstract states until nothing changes.
+    Return the new commands and path beginnings.
+    """
+    # a state is (offset or None, {offset: value or None} or None); None for
+    # both means nothing is known
+    states = [None] * len(commands)
+    states[0] = (0, {})
+    for b in begs:
+        states[b] = (0, {})
+    work = [0] + list(begs)
+    while work:
+        j = work.pop()
+        x, a = commands[j]
+        off, env = states[j]
+        if x in (DECREMENT, INCREMENT):
+            if off is None:
+                env = None
+            elif env is not None:
+                v = _known_cell(env, off)
+                if v is not None: # an unknown value stays unknown
+                    env = dict(env)
+                    env[off] = v - a if x == DECREMENT else v + a
+            nexts = (j + 1,)
+        elif x in (PREV, NEXT):
+            if off is not None:
+                off = off - a if x == PREV else off + a
+            nexts = (j + 1,)
+        elif x == IF:
+            v = w = None
+            if off is not None and env is not None:
+                v, w = _known_cell(env, off), _known_cell(env, off - 1)
+            if v is None or w is None:
+                nexts = (a, j + 1)
+            else:
+                nexts = (a,) if v != w else (j + 1,)
+        elif x == GOTO:
+            nexts = (a,)
+        else: # EXIT
+            nexts = ()
+        for n in nexts:
+            merged = _merge_fold_states(states[n], (off, env))
+            if merged != states[n]:
+                states[n] = merged
+                work.append(n)
+
+    ncommands, new_pos = [], []
+    for j, (x, a) in enumerate(commands):
+        new_pos.append(len(ncommands))
+        if states[j] is None: # unreachable
+            continue
+        if x == IF:
+            off, env = states[j]
+            if off is not None and env is not None:
+                v, w = _known_cell(env, off), _known_cell(env, off - 1)
+                if v is not None and w is not None:
+                    x, a = GOTO, a if v != w else j + 1
+        if x == GOTO and a == j + 1:
+            continue
+        ncommands.append((x, a))
+    if len(ncommands) == len(commands) and \
+            all(c[0] == n[0] for c, n in zip(commands, ncommands)):
+        return commands, begs
+    ncommands = [(x, new_pos[a]) if x in (GOTO, IF) else (x, a)
+                 for x, a in ncommands]
+    return ncommands, [new_pos[b] for b in begs]
+
+def _counting_loop(commands, j):
+    """
+    Return the amount added to the current cell per round if command j is
+    an IF that starts a loop doing nothing else until the cell equals the
+    one before it, or 0 if it is not.
+    """
+    x, a = commands[j]
+    if x == IF and a + 1 < len(commands) and \
+            commands[a][0] in (DECREMENT, INCREMENT) and \
+            commands[a + 1][0] == GOTO and commands[a + 1][1] == j:
+        d = commands[a][1]
+        return -d if commands[a][0] == DECREMENT else d
+    return 0
+
+def _pack_commands(commands):
+    """
+    Split a sequence of (operation, argument) pairs into two flat arrays for
+    the interpreter. A DECREMENT or PREV becomes an INCREMENT or NEXT with a
+    negated argument, so the interpreter only has two memory operations. An
+    IF that starts a counting loop (see _counting_loop) becomes a _COUNT_IF,
+    which runs the whole loop in one step, and any other GOTO to an IF
+    becomes a _GOTO_IF, which does the test of that IF itself.
+    """
+    ops, args = array.array('B'), array.array('q')
+    for j, (x, a) in enumerate(commands):
+        if x == DECREMENT or x == PREV:
+            x, a = _compl_action_map[x], -a
+        elif x == IF and _counting_loop(commands, j):
+            x = _COUNT_IF
+        elif x == GOTO and commands[a][0] == IF and \
+                not _counting_loop(commands, a):
+            x = _GOTO_IF
+        ops.append(x)
+        args.append(a)
+    return ops, args
+
+def _interp_core(ops, args, cells, origin, i, j, budget=-1):
+    """
+    Run the packed commands in ops and args from command j on cells, a dense
+    tape list where memory cell #0 is stored at index origin, with the car at
+    index i. The tape grows when the car moves past either end of it. Each
+    jump uses up one unit of budget, and the run stops at the target of the
+    jump that uses up the last of it; a negative budget never runs out.
+
+    Return the tape, its origin, the index of the car, the command to go on
+    from (None after EXIT), and the budget left.
+    """
+    # local names are faster to look up than globals in the loop
+    _INC, _IF, _GOTOIF, _GOTO, _COUNTIF = \
+        INCREMENT, IF, _GOTO_IF, GOTO, _COUNT_IF
+    size = len(cells)
+    while True:
+        x, a = ops[j], args[j] # operation, argument
+        # Branch on the opcode ranges first (the two memory operations left
+        # after packing are numbered below IF), so that the memory operations
+        # and IF need at most two comparisons. The other jumps take three to
+        # five, and EXIT, which runs only once, is tested last.
+        if x < _IF:
+            if x == _INC:
+                cells[i] += a
+            else: # NEXT
+                i += a
+                if i >= size:
+                    cells.extend([0] * max(size, i + 1 - size))
+                    size = len(cells)
+                elif i < 1: # IF also reads the cell before the current one
+                    n = max(size, 1 - i)
+                    cells[:0] = [0] * n
+                    size += n
+                    i += n
+                    origin += n
+        elif x == _IF:
+            if cells[i] != cells[i - 1]:
+                j = a # go to the operation in address a
+                budget -= 1
+                if not budget:
+                    break
+                continue
+        elif x == _GOTOIF: # a GOTO to the IF in address a
+            if cells[i] != cells[i - 1]:
+                j = args[a]
+            else:
+                j = a + 1
+            budget -= 1
+            if not budget:
+                break
+            continue
+        elif x == _GOTO:
+            j = a # go to the operation in address a
+            budget -= 1
+            if not budget:
+                break
+            continue
+        elif x == _COUNTIF: # an IF looping over adding args[a] to the cell
+            n = cells[i - 1] - cells[i]
+            if n % args[a] == 0 and n // args[a] >= 0:
+                cells[i] += n # the loop ends after n // args[a] rounds
+            else: # the loop never ends
+                j = a
+                budget -= 1
+                if not budget:
+                    break
+                continue
+        else: # EXIT
+            j = None
+            break
+        j += 1
+    return cells, origin, i, j, budget
+
+def _gen_interp_core(commands, begs):
+    """
+    Generate and compile a Python function that runs commands like
+    _interp_core does (without a budget), but with the operations of each
+    basic block written out inline, so that only jumps between blocks need a
+    dispatch.
+    """
+    leaders = set([0])
+    leaders.update(begs)
+    for j, (x, a) in enumerate(commands):
+        if x in (IF, GOTO):
+            leaders.add(a)
+        if x in (IF, GOTO, EXIT):
+            leaders.add(j + 1)
+    leaders = sorted(b for b in leaders if b < len(commands))
+    leader_set = set(leaders)
+
+    def block(b, ind):
+        """Return the lines of the basic block that starts at command b."""
+        code = []
+        j = b
+        while True:
+            x, a = commands[j]
+            if x == DECREMENT:
+                code.append('cells[i] -= {}'.format(a))
+            elif x == INCREMENT:
+                code.append('cells[i] += {}'.format(a))
+            elif x == PREV:
+                code.extend(('i -= {}'.format(a),
+                             'if i < 1:',
+                             '    n = max(len(cells), 1 - i)',
+                             '    cells[:0] = [0] * n',
+                             '    i += n',
+                             '    origin += n'))
+            elif x == NEXT:
+                code.extend(('i += {}'.format(a),
+                             'if i >= len(cells):',
+                             '    cells.extend([0] * max(len(cells),'
+                             ' i + 1 - len(cells)))'))
+            elif x == IF:
+                d = _counting_loop(commands, j)
+                if d: # run the whole loop at once, see _interp_core
+                    code.extend(('n = cells[i - 1] - cells[i]',
+                                 'if n % {0} == 0 and n // {0} >= 0:'.format(d),
+                                 '    cells[i] += n',
+                                 '    j = {}'.format(j + 1),
+                                 'else:',
+                                 '    j = {}'.format(a)))
+                else:
+                    code.extend(('if cells[i] != cells[i - 1]:',
+                                 '    j = {}'.format(a),
+                                 'else:',
+                                 '    j = {}'.format(j + 1)))
+                break
+            elif x == GOTO:
+                code.append('j = {}'.format(a))
+                break
+            else: # EXIT
+                code.append('return cells, origin')
+                break
+            j += 1
+            if j in leader_set:
+                code.append('j = {}'.format(j))
+                break
+        return [ind + line for line in code]
+
+    def dispatch(bs, ind):
+        """Return the lines that pick the block for j among blocks bs."""
+        if len(bs) == 1:
+            return block(bs[0], ind)
+        m = len(bs) // 2
+        return [ind + 'if j < {}:'.format(bs[m])] + \
+            dispatch(bs[:m], ind + '    ') + [ind + 'else:'] + \
+            dispatch(bs[m:], ind + '    ')
+
+    code = ['def interp_core(cells, origin, i, j):',
+            '    while True:']
+    code.extend(dispatch(leaders, ' ' * 8))
+    env = {}
+    exec(compile('\n'.join(code) + '\n', '<hbcht>', 'exec'), env)
+    return env['interp_core']
+
+class _Board:
+    """
+    The rows of operations of a program, with lookups of the next operation
+    in any direction that skip over NOP cells without visiting them
+    """
+    def __init__(self, rows):
+        self.rows = rows
+        self._columns, self._reversed = {}, {}
+
+    def _find_after(self, line, i):
+        """Find the first operation in line after index i, wrapping around."""
+        m = _operation_pattern.search(line, i + 1) or \
+            _operation_pattern.search(line, 0, i + 1)
+        if m is None:
+            raise CarError('infinite loop present')
+        return m.start()
+
+    def _find_before(self, line, i):
+        """Find the last operation in line before index i, wrapping around."""
+        rline = self._reversed.get(line)
+        if rline is None:
+            rline = self._reversed[line] = line[::-1]
+        return len(line) - 1 - self._find_after(rline, len(line) - 1 - i)
+
+    def next_position(self, x, y, direc):
+        """
+        Find the first non-NOP cell after (x, y) in direction direc, wrapping
+        around the edges of the board, and return its position.
+        """
+        if direc == RIGHT:
+            return self._find_after(self.rows[y], x), y
+        elif direc == LEFT:
+            return self._find_before(self.rows[y], x), y
+        column = self._columns.get(x)
+        if column is None:
+            column = self._columns[x] = bytes(
+                row[x] if x < len(row) else NOP for row in self.rows)
+        if direc == DOWN:
+            return x, self._find_after(column, y)
+        else:
+            return x, self._find_before(column, y)
+
 class CarProgram:
     """
     A Half-Broken Car in Heavy Traffic compiler/interpreter wrapper
@@ -451,6 +1024,7 @@ class CarProgram:
         """
         self.file, self.data = file, data
         self.inputastext, self.outputastext = inputastext, outputastext
+        self._native = None
 
     def load_data(self):
         """Parse data."""
@@ -468,6 +1042,14 @@ class CarProgram:
             self.data = self.data.encode(locale.getpreferredencoding())
         self.metadata = {'inputastext': False, 'outputastext': False}
         self.commands, self.command_beginnings = self._parse_data(self.data)
+        self._ops, self._args = _pack_commands(self.commands)
+        self._core = None
+        # jumps left before run() compiles the program (see _interpret)
+        self._budget = _codegen_budget * len(self.commands) \
+            if len(self.commands) <= _codegen_limit else -1
+        # the command that each path really starts at
+        self._starts = tuple(_skip_gotos(self.commands, j) for j in
+                             [0] + list(self.command_beginnings))
 
     def _parse_data(self, data):
         # Header test
@@ -478,57 +1060,116 @@ class CarProgram:
             compcond = False
         if compcond:
             return self._extract_commands(data)
+        elif isinstance(self.file, str):
+            return self._create_commands_cached(data)
         else:
             return self._create_commands(data)
 
-    def _extract_commands(self, data):
-        """Extract commands from data that comes from a compiled program"""
+    @staticmethod
+    def _decode_commands(data):
+        """
+        Decode and check the commands of a compiled program. Return them
+        along with the path beginnings and the input and output text flags.
+        """
         version = data[6]
         if version > 1:
             raise CarError('only version 1 is supported')
-        if data[8] == 1:
-            if self.inputastext is None:
-                self.inputastext = True
-        if data[9] == 1:
-            if self.outputastext is None:
-                self.outputastext = True
+        inptext, outtext = data[8] == 1, data[9] == 1
         data = data[10:]
-        data = struct.unpack('<' + 'I' * (len(data) // 4), data)
-        commands = tuple((data[i], data[i + 1]) for i in range(3, len(data), 2))
+        if len(data) % 8 != 4:
+            raise CarError('invalid compiled program size')
+        words = array.array(_uint32_code)
+        words.frombytes(data)
+        if sys.byteorder != 'little':
+            words.byteswap()
+        commands = tuple(zip(words[3::2], words[4::2]))
+        for x, a in commands:
+            if not DECREMENT <= x <= EXIT:
+                raise CarError('invalid operation {}'.format(x))
         for x, a in filter(lambda x: x[0] in (GOTO, IF), commands):
             if a >= len(commands):
                 raise CarError('code position out of scope')
-        return commands, data[:3]
+        begs = tuple(words[:3])
+        for b in begs:
+            if b >= len(commands):
+                raise CarError('code position out of scope')
+        # every path has to end in a jump or an exit instead of running past
+        # the last command
+        if not commands or commands[-1][0] not in (GOTO, EXIT):
+            raise CarError('program does not end with a jump or an exit')
+        return commands, begs, inptext, outtext
 
-    def _create_commands(self, data):
-        """Create a tuple of commands from source code"""
-        lines = []
-        idone, odone = False, False
-        for line in data.split(b'\n'):
-            if line.startswith(b'@intext'):
-                if self.inputastext is None:
-                    self.metadata['inputastext'] = True
-                    self.inputastext = True
-                idone = True
-            elif line.startswith(b'@outtext'):
-                if self.outputastext is None:
-                    self.metadata['outputastext'] = True
-                    self.outputastext = True
-                odone = True
+    def _extract_commands(self, data):
+        """Extract commands from data that comes from a compiled program"""
+        commands, begs, inptext, outtext = self._decode_commands(data)
+        if inptext:
+            if self.inputastext is None:
+                self.inputastext = True
+        if outtext:
+            if self.outputastext is None:
+                self.outputastext = True
+        return commands, begs
+
+    def _create_commands_cached(self, data):
+        """
+        Create commands from the source code in the file self.file, reusing
+        the commands stored in the parse cache if the same source has been
+        parsed before.
+        """
+        cachefile, header = _cache_file(data)
+        if not _is_private(os.path.dirname(cachefile)):
+            return self._create_commands(data)
+        try:
+            with open(cachefile, 'rb') as f:
+                cached = f.read()
+        except (IOError, OSError):
+            cached = b''
+        if cached.startswith(header):
+            try:
+                commands, begs, idone, odone = self._decode_commands(
+                    cached[len(header):])
+            except (CarError, IndexError):
+                pass
             else:
-                # remove eventual comment
-                m = re.match(br'(.*?);', line)
-                if m:
-                    line = m.group(1)
-                line = line.rstrip()
-                if line:
-                    lines.append(line)
-        if not idone:
-            if self.inputastext:
+                self._apply_directives(idone, odone)
+                return commands, begs
+        commands, begs = self._create_commands(data)
+        f = io.BytesIO()
+        self._hbcht_compile(f, False, commands, begs,
+                            *_source_lines(data)[1:])
+        # write to a temporary file first so that concurrent runs never see
+        # a partial cache file
+        tmpfile = '{}.{}'.format(cachefile, os.getpid())
+        try:
+            with open(tmpfile, 'wb') as cf:
+                cf.write(header + f.getvalue())
+            os.replace(tmpfile, cachefile)
+        except (IOError, OSError):
+            pass
+        return commands, begs
+
+    def _apply_directives(self, idone, odone):
+        """
+        Act on the @intext and @outtext lines of the source code, unless the
+        text settings were given explicitly.
+        """
+        if idone:
+            if self.inputastext is None:
                 self.metadata['inputastext'] = True
-        if not odone:
-            if self.outputastext:
+                self.inputastext = True
+        elif self.inputastext:
+            self.metadata['inputastext'] = True
+        if odone:
+            if self.outputastext is None:
                 self.metadata['outputastext'] = True
+                self.outputastext = True
+        elif self.outputastext:
+            self.metadata['outputastext'] = True
+
+    def _create_commands(self, data):
+        """Create a tuple of commands from source code"""
+        lines, idone, odone = _source_lines(data)
+        self._apply_directives(idone, odone)
         if not lines:
             raise CarError('no source code')
         min_indent = len(lines[0]) # temporary
@@ -547,26 +1188,20 @@ class CarProgram:
         has_car, has_exit = False, False
         y = 0
         for line in lines:
-            row = array.array('B')
-            x = 0
-            for c in line:
-                try:
-                    op = _opcode_to_const_map[c]
-                except KeyError:
-                    op = NOP
-                if op == CAR:
-                    if has_car:
-                        raise CarError('program can only have one car')
-                    has_car = True
-                    car_pos = (x, y)
-                    row.append(NOP)
-                else:
-                    row.append(op)
-                if op == EXIT:
-                    if has_exit:
-                        raise CarError('program can only have one exit')
-                    has_exit = True
-                x += 1
+            # translate the whole line into operations at once
+            row = line.translate(_opcode_table)
+            x = row.find(_car_byte)
+            if x != -1:
+                if has_car or row.find(_car_byte, x + 1) != -1:
+                    raise CarError('program can only have one car')
+                has_car = True
+                car_pos = (x, y)
+                row = row.replace(_car_byte, _nop_byte)
+            x = row.find(_exit_byte)
+            if x != -1:
+                if has_exit or row.find(_exit_byte, x + 1) != -1:
+                    raise CarError('program can only have one exit')
+                has_exit = True
             board.append(row)
             y += 1
         if not has_car:
@@ -576,6 +1211,7 @@ class CarProgram:
         return self._board_to_commands(board, car_pos)
 
     def _board_to_commands(self, board, car_start_pos):
+        board = _Board(board)
         pos_ids = {}
         commands, begs, xys = [], [], [None]
         for direc in _valid_directions:
@@ -583,28 +1219,32 @@ class CarProgram:
             self._path_to_commands(board, car_start_pos, direc,
                                    commands, xys, pos_ids)
         begs = begs[1:] # first path always starts at position 0
-        return commands, begs
+        commands, begs = _fold_constant_ifs(commands, begs)
+        commands, begs = _coalesce_commands(commands, begs)
+        return _peephole_commands(commands, begs)
 
     def _path_to_commands(self, board, car_pos, direc, commands, xys, pos_ids):
         x, y = car_pos
         begin_pos = len(commands)
+        rows = board.rows
+        # (x, y, direc, begin_pos, IF position) of the paths to continue once
+        # the sub-path after their last IF has been built
+        pending = []
         while True:
-            p = NOP
-            while p == NOP:
-                if direc == UP:
-                    y = (y - 1) % len(board)
-                elif direc == DOWN:
-                    y = (y + 1) % len(board)
-                elif direc == RIGHT:
-                    x = (x + 1) % len(board[y])
-                elif direc == LEFT:
-                    x = (x - 1) % len(board[y])
-                p = board[y]
-                try:
-                    p = p[x]
-                except IndexError:
-                    p = NOP
-            action = None
+            if direc == UP:
+                y = (y - 1) % len(rows)
+            elif direc == DOWN:
+                y = (y + 1) % len(rows)
+            elif direc == RIGHT:
+                x = (x + 1) % len(rows[y])
+            elif direc == LEFT:
+                x = (x - 1) % len(rows[y])
+            p = rows[y]
+            p = p[x] if x < len(p) else NOP
+            if p == NOP: # skip the rest of the gap in one lookup
+                x, y = board.next_position(x, y, direc)
+                p = rows[y][x]
+            action, ended = None, False
             if p == DECREMENT and direc != LEFT:
                 action = DECREMENT
             elif p == INCREMENT and direc != RIGHT:
@@ -617,7 +1257,7 @@ class CarProgram:
                 action = IF
             elif p == EXIT:
                 commands.append((EXIT, 0))
-                break
+                ended = True
             if action:
                 pc = commands[-1] if commands else (None, None)
                 pcx, pca = pc
@@ -641,27 +1281,26 @@ class CarProgram:
                         if pos >= begin_pos and not IF in (x for x, a in commands[pos:]):
                             raise CarError('infinite loop present')
                         commands.append((GOTO, pos))
-                        break
-                    if action in _base_mem_ops:
+                        ended = True
+                    elif action in _base_mem_ops:
                         pos_ids[(x, y)] = len(commands)
                         xys.append((x, y))
-                    if action == DECREMENT:
-                        commands.append([DECREMENT, 1])
-                    elif action == INCREMENT:
-                        commands.append([INCREMENT, 1])
-                    elif action == PREV:
-                        commands.append([PREV, 1])
-                    elif action == NEXT:
-                        commands.append([NEXT, 1])
-                    elif action == IF:
+                        commands.append([action, 1])
+                    else: # IF
                         ndirec = RIGHT if direc == UP else DOWN if direc == RIGHT else \
                             LEFT if direc == DOWN else UP if direc == LEFT else None
                         cid = len(commands)
                         commands.append((None, None)) # temporary
                         xys.append((x, y))
                         pos_ids[(x, y)] = len(commands) - 1
-                        self._path_to_commands(board, (x, y), ndirec, commands, xys, pos_ids)
-                        commands[cid] = (IF, len(commands))
+                        pending.append((x, y, direc, begin_pos, cid))
+                        direc, begin_pos = ndirec, len(commands)
+            if ended:
+                if not pending:
+                    break
+                # the sub-path is done; the IF jumps past it
+                x, y, direc, begin_pos, cid = pending.pop()
+                commands[cid] = (IF, len(commands))
         
     def run(self, input, bruterun=False, directions=None, format_output=False):
         """
@@ -676,29 +1315,29 @@ class CarProgram:
         elif not directions:
             directions = (random.choice(_valid_directions),)
         else:
-            if not isinstance(directions, collections.Iterable):
+            try:
+                iter(directions)
+            except TypeError:
                 directions = (directions,)
             for x in directions:
                 if x not in _valid_directions:
                     raise CarError('invalid direction {}'.format(repr(x)))
         paths = tuple(_direction_to_path_map[x] for x in directions)
-        if not isinstance(input, collections.Iterable):
+        try:
+            iter(input)
+        except TypeError:
             input = (input,)
         if self.inputastext:
-            input = tuple(map(ord, ''.join(map(str, input))))
+            input = _text_codes(''.join([str(x) for x in input]))
         else:
-            ninput = []
-            for x in input:
-                if isinstance(x, str):
-                    ninput.extend(map(ord, x))
-                else:
-                    ninput.append(x)
-            input = ninput
+            input = [v for x in input
+                     for v in (_text_codes(x) if isinstance(x, str)
+                               else (x,))]
 
-        outs = tuple(self._interpret(path, *input) for path in paths)
+        outs = self._interpret_batch(paths, input)
 
         if self.outputastext:
-            outs = tuple(''.join(chr(v) for k, v in out) for out in outs)
+            outs = tuple(''.join([chr(v) for k, v in out]) for out in outs)
         else:
             if format_output:
                 if outs[0]:
@@ -720,37 +1359,130 @@ class CarProgram:
                                                 if not self.outputastext else '')
                              for i in range(len(outs)))
 
+    def _interpret_batch(self, paths, cells):
+        """
+        Run the program on the same input cells for each path in paths.
+        Paths that lead to the same command give the same result, so each
+        such command is only run from once.
+        """
+        outs, done = [], {}
+        for path in paths:
+            j = self._starts[path]
+            if j in done:
+                outs.append(list(done[j]))
+            else:
+                done[j] = out = self._interpret(path, *cells)
+                outs.append(out)
+        return tuple(outs)
+
     def _interpret(self, path, *cells):
-        cells = collections.defaultdict(int, 
-            {i: cells[i] for i in range(len(cells))})
-        commands, begs = self.commands, self.command_beginnings
-        if path == 0:
-            j = 0 ######
-        else:     # current command #
-            j = begs[path - 1] ######
-        i= 0 # current cell
+        if self._native is not None:
+            out = self._native_interpret(path, cells)
+            if out is not None:
+                return out
+        cells = [0] * _tape_margin + list(cells) + [0] * _tape_margin
+        origin = i = _tape_margin # current cell, as an index into the tape
+        j = self._starts[path] # current command #
+        if self._core is None:
+            cells, origin, i, j, self._budget = _interp_core(
+                self._ops, self._args, cells, origin, i, j, self._budget)
+            if j is not None: # the budget ran out, so go on compiled
+                self._core = _gen_interp_core(self.commands,
+                                              self.command_beginnings)
+        if j is not None:
+            cells, origin = self._core(cells, origin, i, j)
+        return [(k - origin, v) for k, v in enumerate(cells) if v != 0]
+
+    def jit_native(self):
+        """
+        Compile the program into native code with the system C compiler (the
+        CC environment variable, or cc) and make run() use it. The shared
+        library is cached next to the parse cache, keyed by its source.
+
+        Return True if native code is available. If not, e.g. because there
+        is no working C compiler, the program keeps being interpreted.
+        """
+        try:
+            import ctypes
+        except ImportError:
+            return False
+        f = io.BytesIO()
+        self._native_compile(f, self.commands, self.command_beginnings)
+        src = f.getvalue()
+        # only trust a cached library in a directory and file that nobody
+        # else can write to; otherwise build a private one for this run
+        cachedir = _cache_dir()
+        cached = _is_private(cachedir)
+        lib = cachedlib = os.path.join(
+            cachedir, hashlib.sha1(src).hexdigest() + '.so')
+        tmpdir = None
+        try:
+            if not (cached and _is_private(cachedlib)):
+                # build in the cache directory if possible, so that the
+                # library can be moved into place atomically
+                tmpdir = tempfile.mkdtemp(prefix='hbcht-',
+                                          dir=cachedir if cached else None)
+                srcfile = os.path.join(tmpdir, 'program.c')
+                libfile = os.path.join(tmpdir, 'program.so')
+                with open(srcfile, 'wb') as f:
+                    f.write(src)
+                cc = os.environ.get('CC', 'cc')
+                with open(os.devnull, 'wb') as null:
+                    try:
+                        ret = subprocess.call(
+                            [cc, '-O2', '-shared', '-fPIC',
+                             '-o', libfile, srcfile], stdout=null, stderr=null)
+                    except OSError:
+                        return False
+                if ret != 0:
+                    return False
+                lib = libfile
+                if cached:
+                    try:
+                        os.chmod(libfile, 0o700)
+                        os.replace(libfile, cachedlib)
+                        lib = cachedlib
+                    except OSError:
+                        pass
+            func = ctypes.CDLL(lib).hbcht_native_run
+        except (OSError, AttributeError):
+            return False
+        finally:
+            if tmpdir is not None:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+        func.restype = ctypes.c_int
+        func.argtypes = (ctypes.POINTER(ctypes.c_int64), ctypes.c_int64,
+                         ctypes.c_int64, ctypes.c_int,
+                         ctypes.POINTER(ctypes.c_int64))
+        self._native = func
+        return True
+
+    def _native_interpret(self, path, cells):
+        """
+        Run a path with the native code from jit_native. Return None if the
+        native tape or its 64-bit cells are not enough for the program.
+        """
+        import ctypes
+        for x in cells:
+            if not isinstance(x, int) or not -2 ** 63 <= x < 2 ** 63:
+                return None
+        origin = _native_tape_margin
+        bounds = (ctypes.c_int64 * 2)()
         while True:
-            x, a = commands[j] # operation, argument
-            if x == DECREMENT:
-                cells[i] -= a
-            elif x == INCREMENT:
-                cells[i] += a
-            elif x == PREV:
-                i -= a
-            elif x == NEXT:
-                i += a
-            elif x == IF:
-                if cells[i] != cells[i - 1]:
-                    j = a # go to the operation in address a
-                    continue
-            elif x == GOTO:
-                j = a # go to the operation in address a
-                continue
-            elif x == EXIT:
+            length = len(cells) + 2 * origin
+            tape = (ctypes.c_int64 * length)()
+            tape[origin:origin + len(cells)] = cells
+            ret = self._native(tape, length, origin, path, bounds)
+            if ret == 0:
                 break
-            j += 1
-        return sorted(filter(lambda kv: kv[1] != 0, cells.items()),
-                      key=lambda kv: kv[0])
+            # 1 means a cell overflowed, 2 that the car ran off the tape
+            if ret != 2 or origin >= _native_tape_max_margin:
+                return None
+            origin *= 4
+        lo = min(bounds[0], origin)
+        hi = max(bounds[1], origin + len(cells) - 1)
+        return [(k - origin, v) for k, v in
+                zip(range(lo, hi + 1), tape[lo:hi + 1]) if v != 0]
 
     def compile(self, outfile=None, language='hbc', functiononly=False,
                 overwrite=False):
@@ -781,17 +1513,15 @@ class CarProgram:
         if no_support:
             raise CarError('no support for language {}'.format(
                     repr(language)))
-        if outfile is None:
-            f = io.BytesIO()
-        elif isinstance(outfile, str):
-            if outfile == '-':
-                outfile = 1
-            f = open(outfile, 'wb')
+        # compile in memory so that the output file gets a single write
+        f = io.BytesIO()
         self._compile(f, language, functiononly)
         if outfile is None:
             return f.getvalue()
-        elif isinstance(outfile, str):
-            f.close()
+        if outfile == '-':
+            outfile = 1
+        with open(outfile, 'wb', closefd=outfile != 1) as out:
+            out.write(f.getbuffer())
 
     def _compile(self, f, lang, funconly):
         commands = self.commands
@@ -810,46 +1540,50 @@ class CarProgram:
         f.write(b'\1hbcht\1\2' +
                 (b'\1' if inptext else b'\2') +
                 (b'\1' if outtext else b'\2'))
-        f.write(struct.pack('<III', *begs))
-        for x, a in commands:
-            f.write(struct.pack('<II', x, a))
+        words = array.array(_uint32_code, begs)
+        words.extend([v for c in commands for v in c])
+        if sys.byteorder != 'little':
+            words.byteswap()
+        f.write(words.tobytes())
 
     @staticmethod
     def _get_gotos(commands):
-        return set(sorted(a for x, a in filter(
-                    lambda kv: kv[0] in (GOTO, IF) and kv[1] != 0, commands)))
+        """Return the set of jump targets in commands, other than 0."""
+        return frozenset([a for x, a in commands
+                          if (x == GOTO or x == IF) and a != 0])
 
     @staticmethod
     def _python_compile(f, funconly, commands, begs, inptext, outtext):
         gotos = CarProgram._get_gotos(commands)
-        code, ddd, dd, d = '', ' ' * 0, ' ' * 4, ' ' * 8
-        code += dd + 'def action_0(i):\n'
+        code, ddd, dd, d = [], ' ' * 0, ' ' * 4, ' ' * 8
+        code.append(dd + 'def action_0(i):\n')
         j = 0
         last_had_skip = False
         for x, a in commands:
             if j in begs:
-                code += dd + 'def action_{}(i):\n'.format(j)
+                code.append(dd + 'def action_{}(i):\n'.format(j))
             elif j in gotos:
                 if not last_had_skip:
-                    code += d + 'return (action_{j}, i)\n'.format(j=j)
-                code += dd + 'def action_{j}(i):\n'.format(j=j)
+                    code.append(d + 'return (action_{j}, i)\n'.format(j=j))
+                code.append(dd + 'def action_{j}(i):\n'.format(j=j))
             if x == DECREMENT:
-                code += d + 'cells[i] -= {}\n'.format(a)
+                code.append(d + 'cells[i] -= {}\n'.format(a))
             elif x == INCREMENT:
-                code += d + 'cells[i] += {}\n'.format(a)
+                code.append(d + 'cells[i] += {}\n'.format(a))
             elif x == PREV:
-                code += d + 'i -= {}\n'.format(a)
+                code.append(d + 'i -= {}\n'.format(a))
             elif x == NEXT:
-                code += d + 'i += {}\n'.format(a)
+                code.append(d + 'i += {}\n'.format(a))
             elif x == GOTO:
-                code += d + 'return (action_{}, i)\n'.format(a)
+                code.append(d + 'return (action_{}, i)\n'.format(a))
             elif x == IF:
-                code += d + 'if cells[i] != cells[i - 1]:\n' + \
-                    d + dd + 'return (action_{}, i)\n'.format(a)
+                code.append(d + 'if cells[i] != cells[i - 1]:\n' +
+                            d + dd + 'return (action_{}, i)\n'.format(a))
             elif x == EXIT:
-                code += d + 'return None\n'
-                if not j + 1 in begs and j + 1 not in gotos:
-                    code += dd + 'def action_{}(i):\n'.format(j + 1)
+                code.append(d + 'return None\n')
+                if not j + 1 in begs and j + 1 not in gotos and \
+                        j + 1 < len(commands):
+                    code.append(dd + 'def action_{}(i):\n'.format(j + 1))
             last_had_skip = x in (GOTO, EXIT)
             j += 1
 
@@ -862,7 +1596,7 @@ class CarProgram:
                 outputconv=_python_code_wrapper_outtext if outtext else
                 _python_code_wrapper_not_outtext,
                 codebeginnings=', '.join(map(str, begs)),
-                codebody=code
+                codebody=''.join(code)
                 ).encode())
         if not funconly:
             f.write(_python_code_cmdline)
@@ -872,107 +1606,116 @@ class CarProgram:
         raise Exception('compiler not implented yet')
         # These are just mutterings.
         gotos = CarProgram._get_gotos(commands)
-        code = ''
-        code += '0\n'
+        code = ['0\n']
         j = 0
         last_had_skip = False
         for x, a in commands:
             if j in begs:
-                code += '\n{}:'.format(j)
+                code.append('\n{}:'.format(j))
             elif j in gotos:
                 if not last_had_skip:
-                    code += '{j}'.format(j=j)
-                code += '\n{j}:'.format(j=j)
+                    code.append('{j}'.format(j=j))
+                code.append('\n{j}:'.format(j=j))
             if x == DECREMENT:
-                code += '-' * a
+                code.append('-' * a)
             elif x == INCREMENT:
-                code += '+' * a
+                code.append('+' * a)
             elif x == PREV:
-                code += '<' * a
+                code.append('<' * a)
             elif x == NEXT:
-                code += '>' * a
+                code.append('>' * a)
             elif x == GOTO:
-                code += '{}'.format(a)
+                code.append('{}'.format(a))
             elif x == IF:
-                code += '''
+                code.append('''
 <[)+>+<(-])>[-<(+)>]<(>
 [)+>+<(-])>[-<(+)>]
 <[->-<]
 [[-]<[-]>({}][-]<[-]>(
-'''.format(a)
+'''.format(a))
             elif x == EXIT:
-                code += '#'
+                code.append('#')
                 if not j + 1 in begs and j + 1 not in gotos:
-                    code += '\n{}:'.format(j + 1)
+                    code.append('\n{}:'.format(j + 1))
             last_had_skip = x in (GOTO, EXIT)
             j += 1
 
         f.write(b'// Start in one of these states: 0, ' + ', '.join(map(str, begs)).encode() + b'\n')
-        f.write(code.encode())
+        f.write(''.join(code).encode())
             
     @staticmethod
     def _c_compile(f, funconly, commands, begs, inptext, outtext):
-        f.write(b'// Generated by hbcht <http://metanohi.name/projects/hbcht/>\n')
+        # collect the code in memory and write it to f at once
+        buf = bytearray()
+        buf.extend(b'// Generated by hbcht <http://metanohi.name/projects/hbcht/>\n')
         if inptext:
-            f.write(b'#define INPUTASTEXT\n')
+            buf.extend(b'#define INPUTASTEXT\n')
         if outtext:
-            f.write(b'#define OUTPUTASTEXT\n')
-        ht = 'hbchtpos'
-        write = lambda t: f.write(t.encode())
-        f.write(b'#define HBCHT_BODY \\\n')
-        write('switch (random) {{ \\\ncase 0: goto {}0; break; \\\n'.format(ht));
-        for i in range(len(begs)):
-            write('case {i}: goto {h}{x}; break; \\\n'.format(i=i + 1, x=begs[i], h=ht));
-        f.write(b'} \\\n');
+            buf.extend(b'#define OUTPUTASTEXT\n')
+        buf.extend(b'#define HBCHT_BODY \\\nswitch (random) { \\\n')
+        buf.extend(b''.join([_c_code_case % (i, x) for i, x
+                             in enumerate([0] + list(begs))]))
+        buf.extend(b'} \\\n')
 
         gotos = CarProgram._get_gotos(commands)
-        j = 0
+        starts = frozenset(begs)
+        # this loop runs once per command, so bind what it uses
+        _GOTO, _EXIT = GOTO, EXIT
+        code, label, goto, end = \
+            _c_code_commands, _c_code_label, _c_code_goto, _c_code_exit
+        extend = buf.extend
         last_had_skip = False
-        write('{}0: \\\n'.format(ht))
-        for x, a in commands:
-            if j in begs:
-                write('{}{}: \\\n'.format(ht, j))
+        extend(label % 0)
+        for j, (x, a) in enumerate(commands):
+            if j in starts:
+                extend(label % j)
             elif j in gotos:
                 if not last_had_skip:
-                    write('goto {h}{j}; \\\n'.format(h=ht, j=j))
-                write('{h}{j}: \\\n'.format(h=ht, j=j))
-            if x == DECREMENT:
-                write('hbcht_dec_cell(cells, i, {}); \\\n'.format(a))
-            elif x == INCREMENT:
-                write('hbcht_inc_cell(cells, i, {}); \\\n'.format(a))
-            elif x == PREV:
-                write('i -= {}; \\\n'.format(a))
-            elif x == NEXT:
-                write('i += {}; \\\n'.format(a))
-            elif x == GOTO:
-                write('goto {}{}; \\\n'.format(ht, a))
-            elif x == IF:
-                write('if (hbcht_get_cell_value(cells, i) != \
-hbcht_get_cell_value(cells, i - 1)) \\\n    goto {}{}; \\\n'.format(ht, a))
-            elif x == EXIT:
-                write('goto {}end; \\\n'.format(ht))
-                if not j + 1 in begs and j + 1 not in gotos:
-                    write('{}{}: \\\n'.format(ht, j + 1))
-            j += 1
-            last_had_skip = x in (GOTO, EXIT)
+                    extend(goto % j)
+                extend(label % j)
+            if x == _EXIT:
+                extend(end)
+            else:
+                extend(code[x] % a)
+            last_had_skip = x == _GOTO or x == _EXIT
         
-        f.write(_c_template)
-        if not funconly:
-            f.write(_c_template_mainfunc)
+        buf.extend(_c_template if funconly else _c_template_full)
+        f.write(buf)
+
+    @staticmethod
+    def _native_compile(f, commands, begs):
+        buf = bytearray()
+        buf.extend(b'// Generated by hbcht <http://metanohi.name/projects/hbcht/>\n')
+        buf.extend(b'#define HBCHT_BODY \\\nswitch (path) { \\\n')
+        buf.extend(b''.join([_native_code_case % (i, x) for i, x
+                             in enumerate([0] + list(begs))]))
+        buf.extend(b'} \\\n')
+
+        for j, (x, a) in enumerate(commands):
+            buf.extend(_c_code_label % j)
+            if x == EXIT:
+                buf.extend(_native_code_exit)
+            else:
+                buf.extend(_native_code_commands[x] % a)
+        buf.extend(_native_template)
+        f.write(buf)
 
 class _SimplerOptionParser(OptionParser):
     """A simplified OptionParser"""
 
-    def format_description(self, formatter):
-        self.description = self.description.strip()
-        return OptionParser.format_description(self, formatter)
+    def __init__(self, *args, **kwds):
+        # strip the texts once instead of whenever help is formatted
+        for key in ('description', 'epilog'):
+            if kwds.get(key):
+                kwds[key] = kwds[key].strip()
+        OptionParser.__init__(self, *args, **kwds)
 
     def format_epilog(self, formatter):
-        return self.epilog.strip() + '\n'
+        return self.epilog + '\n'
 
     def add_option(self, *args, **kwds):
-        try: kwds['help'] = kwds['help'].strip()
-        except KeyError: pass
+        if kwds.get('help'):
+            kwds['help'] = kwds['help'].strip()
         return OptionParser.add_option(self, *args, **kwds)
 
 def parse_args(cmdargs=None):
@@ -1110,6 +1853,12 @@ do not show output as a text string instead of a list of numbers. Overwrites
 `@outtext' command in program file if present
 ''')
 
+    parser.add_option('-n', '--native', dest='native',
+                      action='store_true', help='''
+when running, translate the program into native code with the system C
+compiler first, if there is one
+''', default=False)
+
     parser.add_option('-y', '--overwrite-file', dest='overwrite',
                       action='store_true', help='''
 when compiling, overwrite the output file if it exists
@@ -1123,21 +1872,18 @@ when compiling, overwrite the output file if it exists
                                    functiononly=o.functiononly,
                                    overwrite=o.overwrite)
     else:
-        for i in range(len(o.directions)):
-            try:
-                o.directions[i] = _direction_text_to_const_map[
-                    o.directions[i][0].lower()]
-            except KeyError:
-                parser.error('{} is not a valid direction'.format(
-                        o.directions[i]))
-        inputs = []
-        for x in a[1:]:
-            try:
-                inputs.append(int(x))
-            except ValueError:
-                inputs.append(x)
-        _run = lambda c: c.run(inputs, bruterun=o.bruterun,
-                               directions=o.directions, format_output=True)
+        for i, d in enumerate(o.directions):
+            direc = _direction_ord_to_const_map.get(ord(d[0]) | 0x20) \
+                if d else None
+            if direc is None:
+                parser.error('{} is not a valid direction'.format(d))
+            o.directions[i] = direc
+        inputs = [_int_or_text(x) for x in a[1:]]
+        def _run(c):
+            if o.native:
+                c.jit_native()
+            return c.run(inputs, bruterun=o.bruterun,
+                         directions=o.directions, format_output=True)
     try:
         c = CarProgram(file=a[0], inputastext=o.inputastext,
                        outputastext=o.outputastext)
@@ -1145,9 +1891,11 @@ when compiling, overwrite the output file if it exists
         out = _run(c)
         if out is not None:
             print(out, end='')
-    except CarError as e:
+    except (CarError, EnvironmentError) as e:
         print('hbcht: error:', str(e), file=sys.stderr)
+        sys.exit(1)
     except Exception as e:
+        # unexpected errors, so show where they came from
         print('hbcht: error:', str(e), file=sys.stderr)
         import traceback
         print(traceback.format_exc().rstrip(), file=sys.stderr)